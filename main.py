@@ -1,5 +1,7 @@
 import pytorch_lightning as pl
 from pytorch_lightning import loggers
+from pytorch_lightning.plugins import DDPPlugin
+from pytorch_lightning.utilities.device_parser import parse_gpu_ids
 from l5kit.configs import load_config_data
 from raster.lyft import LyftTrainerModule, LyftDataModule
 from pathlib import Path
@@ -34,7 +36,15 @@ if __name__ == '__main__':
     logger = loggers.TensorBoardLogger(save_dir=args.log_root, name='default' if not args.name else args.name,
                                        default_hp_metric=False, log_graph=False)
     checkpoint = pl.callbacks.ModelCheckpoint(monitor='loss/val', save_last=True, verbose=True, mode='min')
-    trainer = pl.Trainer.from_argparse_args(args, checkpoint_callback=checkpoint, callbacks=callbacks, logger=logger)
+    # multi-gpu training defaults to ddp (dp re-replicates the model every step and is bound by the GIL), every
+    # parameter takes part in each step so ddp can skip the unused parameters search and overlap bucketed allreduces
+    plugins = []
+    if args.accelerator is None and len(parse_gpu_ids(args.gpus) or []) > 1:
+        args.accelerator = 'ddp'
+    if args.accelerator == 'ddp':
+        plugins.append(DDPPlugin(find_unused_parameters=False))
+    trainer = pl.Trainer.from_argparse_args(args, checkpoint_callback=checkpoint, callbacks=callbacks, logger=logger,
+                                            plugins=plugins)
     config = load_config_data(args.config)
     args_dict = vars(args)
     args_dict['config'] = config
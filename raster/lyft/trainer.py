@@ -1,4 +1,5 @@
 from abc import ABC
+from contextlib import contextmanager, nullcontext
 
 import torch
 import pytorch_lightning as pl
@@ -10,8 +11,8 @@ from raster.utils import KeyValue, boolify
 from l5kit.configs import load_config_data
 
 from .saliency_supervision import SaliencySupervision
-from .utils import find_batch_extremes, filter_batch, neg_multi_log_likelihood, write_pred_csv_header, \
-    write_pred_csv_data
+from .utils import find_batch_extremes, filter_batch, neg_multi_log_likelihood, perturb, \
+    write_pred_csv_header, write_pred_csv_data
 from argparse import ArgumentParser
 from pytorch_lightning.utilities.distributed import rank_zero_only
 
@@ -47,6 +48,11 @@ class LyftTrainerModule(pl.LightningModule, ABC):
             pgd_eps_vehicles: float = 0.4,
             pgd_eps_semantics: float = 0.15625,
             track_grad: bool = False,
+            autocast: th.Optional[str] = None,
+            channels_last: bool = False,
+            compile_mode: th.Optional[str] = None,
+            adv_log_freq: th.Optional[int] = None,
+            empty_cache_freq: int = 64,
             test_csv_path: str = None,
             **kwargs,
     ):
@@ -56,6 +62,27 @@ class LyftTrainerModule(pl.LightningModule, ABC):
         # initializing model
         self.model = getattr(models, self.hparams.model)(config=self.hparams.config, modes=self.hparams.modes,
                                                          **(self.hparams.model_dict or dict()))
+        if self.hparams.channels_last:
+            self.model = self.model.to(memory_format=torch.channels_last)
+        # mixed precision
+        self.autocast_dtype = None
+        if self.hparams.autocast:
+            if self.hparams.autocast not in ('bfloat16', 'float16'):
+                raise ValueError(f'unsupported autocast dtype {self.hparams.autocast} [bfloat16/float16]')
+            if not hasattr(torch, 'autocast'):
+                raise ValueError('autocast requires torch>=1.10')
+            self.autocast_dtype = getattr(torch, self.hparams.autocast)
+        # compiling the forward in place (before any strategy wrapping) keeps parameter names and checkpoints intact
+        self.compiled = False
+        if self.hparams.compile_mode and self.hparams.saliency_factor:
+            print('model compilation skipped, saliency supervision requires double backward through the model')
+        elif self.hparams.compile_mode and self.hparams.get('accelerator', None) in ('ddp_spawn', 'ddp_cpu'):
+            print('model compilation skipped, compiled models can not be pickled for spawned processes')
+        elif self.hparams.compile_mode and not hasattr(torch, 'compile'):
+            print('model compilation skipped, torch.compile requires torch>=2.0')
+        elif self.hparams.compile_mode:
+            self.model.forward = torch.compile(self.model.forward, mode=self.hparams.compile_mode, dynamic=False)
+            self.compiled = True
         # saliency
         self.saliency = SaliencySupervision(
             self.hparams.config, self.hparams.saliency_intrest, **(self.hparams.saliency_dict or dict())
@@ -64,6 +91,17 @@ class LyftTrainerModule(pl.LightningModule, ABC):
         self.lr = self.hparams.lr
         self.track_grad = self.hparams.track_grad
         self.val_hparams = 0.
+        # per-channel pgd epsilon bound, kept on the module's device (not part of checkpoints)
+        eps = torch.empty(1, self.model.in_channels, 1, 1)
+        eps[:, :-3] = self.hparams.pgd_eps_vehicles
+        eps[:, -3:] = self.hparams.pgd_eps_semantics
+        self.register_buffer('pgd_eps', eps, persistent=False)
+        # reusable pgd perturbation buffer, reallocated only when the input shape changes
+        self._delta_buffer = None
+        # batch norm, dropout layers and parameters of the model, collected on the first attack
+        self._batch_norms = None
+        self._dropouts = None
+        self._model_params = None
 
         # test variables
         self.test_csv_path = test_csv_path
@@ -82,80 +120,144 @@ class LyftTrainerModule(pl.LightningModule, ABC):
         if self.logger:
             self.logger.log_hyperparams(self.hparams, metrics=metric_placeholder)
 
-    def pgd_attack(self, inputs, outputs, target_availabilities=None, return_loss=True):
-        targets = outputs
-        if self.hparams.pgd_random_start or self.hparams.pgd_mode == 'negative_sample':
-            delta = (torch.rand_like(inputs) - 0.5) * 2
-            for (s_channel, end_channel), eps in [
-                ((- 3, None), self.hparams.pgd_eps_semantics),
-                ((0, - 3), self.hparams.pgd_eps_vehicles)
-            ]:
-                delta[:, s_channel:end_channel] *= eps
-            delta.requires_grad = True
-        else:
-            delta = torch.zeros_like(inputs, requires_grad=True)
+    def model_forward(self, inputs):
+        # the model runs in reduced precision while predictions (and thus losses) are kept in float32
+        with torch.autocast(self.device.type, dtype=self.autocast_dtype) if self.autocast_dtype else nullcontext():
+            pred, conf = self.model(inputs)
+        return pred.float(), conf.float()
 
-        # freezing model params
-        for param in self.parameters():
-            param.requires_grad = False
-        self.eval()
-        if self.hparams.pgd_mode == 'negative_sample':
-            targets, _ = self.model(inputs.detach())
-        for i in range(self.hparams.pgd_iters):
-            loss = neg_multi_log_likelihood(targets, *self.model((inputs.detach() + delta).clamp(0, 1.)),
-                                            target_availabilities).mean()
-            if i == 0 and return_loss:
-                init_loss = loss.detach()
-            loss.backward()
-            delta.data = delta.data + self.hparams.pgd_alpha * delta.grad.detach().sign()
-            for (s_channel, end_channel), eps in [
-                ((- 3, None), self.hparams.pgd_eps_semantics),
-                ((0, - 3), self.hparams.pgd_eps_vehicles)
-            ]:
-                delta.data[:, s_channel:end_channel].clamp_(-eps, eps)
-            delta.grad.zero_()
-        if return_loss:
-            final_loss = neg_multi_log_likelihood(targets, *self.model((inputs + delta).detach().clamp(0, 1.)),
-                                                  target_availabilities).mean()
+    def stochastic_layers(self):
+        # batch norm and dropout layers, the only ones behaving differently between train and eval modes
+        if self._batch_norms is None:
+            self._batch_norms = [
+                m for m in self.model.modules() if isinstance(m, torch.nn.modules.batchnorm._BatchNorm)]
+            self._dropouts = [m for m in self.model.modules() if isinstance(m, torch.nn.modules.dropout._DropoutNd)]
+        return self._batch_norms + self._dropouts
+
+    @contextmanager
+    def frozen_stochastic_layers(self):
+        # only batch norm and dropout layers are switched to eval mode (instead of walking the whole module tree),
+        # so the attack uses running stats without updating them and is deterministic
+        layers = self.stochastic_layers()
+        modes = [layer.training for layer in layers]
+        for layer in layers:
+            layer.train(False)
+        try:
+            yield
+        finally:
+            for layer, mode in zip(layers, modes):
+                layer.train(mode)
+
+    @contextmanager
+    def frozen_parameters(self):
+        # a compiled model backpropagates through a single node that computes every weight gradient regardless of
+        # the requested inputs, so weights are frozen to keep the attack's backward w.r.t. delta only
+        if not self.compiled:
+            yield
+            return
+        if self._model_params is None:
+            self._model_params = list(self.model.parameters())
+        requires_grad = [param.requires_grad for param in self._model_params]
+        for param in self._model_params:
+            param.requires_grad_(False)
+        try:
+            yield
+        finally:
+            for param, req in zip(self._model_params, requires_grad):
+                param.requires_grad_(req)
+
+    def pgd_attack(self, inputs, outputs, target_availabilities=None, return_loss=True, precomputed_targets=None):
+        targets = outputs.detach()  # no history of the targets is kept across pgd iterations
+        eps = self.pgd_eps
+        if self._delta_buffer is None or self._delta_buffer.shape != inputs.shape or \
+                self._delta_buffer.device != inputs.device or self._delta_buffer.dtype != inputs.dtype:
+            self._delta_buffer = torch.empty_like(inputs)
+        delta = self._delta_buffer
+        with torch.no_grad():
+            if self.hparams.pgd_random_start or self.hparams.pgd_mode == 'negative_sample':
+                delta.uniform_(-1., 1.).mul_(eps)
+            else:
+                delta.zero_()
+        delta.requires_grad_(True)
+
+        # gradients are only taken w.r.t. delta (weights are additionally frozen for compiled models)
+        with self.frozen_stochastic_layers(), self.frozen_parameters():
+            if self.hparams.pgd_mode == 'negative_sample':
+                if precomputed_targets is not None:
+                    targets = precomputed_targets.detach()
+                else:
+                    with torch.no_grad():
+                        targets = self.model_forward(inputs.detach())[0]
+            for i in range(self.hparams.pgd_iters):
+                loss = neg_multi_log_likelihood(targets, *self.model_forward(perturb(inputs.detach(), delta)),
+                                                target_availabilities).mean()
+                if i == 0 and return_loss:
+                    init_loss = loss.detach()
+                # semi-backward: only differentiate w.r.t. delta, model params are never visited
+                grad = torch.autograd.grad(loss, delta, only_inputs=True)[0]
+                with torch.no_grad():
+                    # stepping and projecting in place keeps the whole attack inside the delta buffer
+                    delta.add_(grad.sign_(), alpha=self.hparams.pgd_alpha)
+                    delta.clamp_(min=-eps, max=eps)
+            if return_loss:
+                with torch.no_grad():
+                    final_loss = neg_multi_log_likelihood(
+                        targets, *self.model_forward(perturb(inputs.detach(), delta.detach())),
+                        target_availabilities).mean()
 
-        # unfreezing model
-        for param in self.parameters():
-            param.requires_grad = True
-        self.train()
         if return_loss:
-            return (inputs.detach() + delta.detach()).clamp(0, 1.), init_loss, final_loss
-        return (inputs.detach() + delta.detach()).clamp(0, 1.)
+            return perturb(inputs.detach(), delta.detach()), init_loss, final_loss
+        return perturb(inputs.detach(), delta.detach())
 
     def forward(self, inputs, targets: torch.Tensor, target_availabilities: torch.Tensor = None, world_from_agent: torch.Tensor = None, centroid: torch.Tensor = None, return_results=True,
                 grad_enabled=True, attack=True, return_trajectory=False):
         torch.set_grad_enabled(grad_enabled)
         res = dict()
+        if self.hparams.channels_last:
+            # pgd perturbations follow the memory format of the inputs they are built from
+            inputs = inputs.contiguous(memory_format=torch.channels_last)
         perf_attack = self.hparams.pgd_iters and attack
         reg_pgd = perf_attack and self.hparams.pgd_reg_factor
+        # clean predictions double as negative sample attack targets when inputs are not replaced by adversaries,
+        # as long as train mode predictions match the eval mode ones the attack is run with
+        share_clean = reg_pgd and self.hparams.pgd_mode == 'negative_sample' and not self.stochastic_layers()
+        if share_clean:
+            inputs.requires_grad = bool(self.hparams.saliency_factor) or self.track_grad
+            pred, conf = self.model_forward(inputs)
         if perf_attack:
-            adv_inputs, init_loss, final_loss = self.pgd_attack(
-                inputs, targets, target_availabilities, return_loss=True)
+            # attack losses are only used for logging, so they are evaluated every once in a while
+            freq = self.trainer.log_every_n_steps if self.hparams.adv_log_freq is None else self.hparams.adv_log_freq
+            # lightning only writes step metrics when (global_step + 1) is a multiple of its logging interval
+            log_adv = bool(freq) and (self.global_step + 1) % freq == 0
+            attack_res = self.pgd_attack(
+                inputs, targets, target_availabilities, return_loss=log_adv,
+                precomputed_targets=pred.detach() if share_clean else None)
+            if log_adv:
+                adv_inputs, res['adv/init_loss'], res['adv/final_loss'] = attack_res
+            else:
+                adv_inputs = attack_res
             if not self.hparams.pgd_reg_factor:
                 inputs = adv_inputs
-            res['adv/init_loss'] = init_loss
-            res['adv/final_loss'] = final_loss
-        inputs.requires_grad = bool(self.hparams.saliency_factor) or self.track_grad
-        pred, conf = self.model(inputs)
+        if not share_clean:
+            inputs.requires_grad = bool(self.hparams.saliency_factor) or self.track_grad
+            pred, conf = self.model_forward(inputs)
         nll = neg_multi_log_likelihood(targets, pred, conf, target_availabilities)
         if (self.hparams.saliency_factor or self.track_grad) and grad_enabled:
             grads = torch.autograd.grad(
-                nll.unbind(), inputs, create_graph=bool(self.hparams.saliency_factor), retain_graph=True)[0]
-            axis = [1, 2, 3] if return_trajectory else [0, 1, 2, 3]
-            res['grads/semantics'] = grads.data[:, -3:].abs().sum(axis=axis)
-            res['grads/vehicles'] = grads.data[:, :-3].abs().sum(axis=axis)
-            res['grads/total'] = res['grads/semantics'] + res['grads/vehicles']
+                nll.sum(), inputs, create_graph=bool(self.hparams.saliency_factor), retain_graph=True)[0]
+            # grad norms are only reported when tracked (or written out along with test trajectories)
+            if self.track_grad or return_trajectory:
+                axis = [1, 2, 3] if return_trajectory else [0, 1, 2, 3]
+                res['grads/semantics'] = grads.data[:, -3:].norm(p=1, dim=axis)
+                res['grads/vehicles'] = grads.data[:, :-3].norm(p=1, dim=axis)
+                res['grads/total'] = res['grads/semantics'] + res['grads/vehicles']
         if return_trajectory:
             res['nll'] = nll
         else:
             res['nll'] = nll.mean()
         if reg_pgd:
             adv_nll = neg_multi_log_likelihood(pred.detach() if self.hparams.pgd_mode == 'negative_sample' else targets,
-                                               *self.model(adv_inputs), target_availabilities)
+                                               *self.model_forward(adv_inputs), target_availabilities)
             res['adv/nll'] = adv_nll.mean()
         if self.hparams.saliency_factor and grad_enabled:
             sal_res = self.saliency(grads)
@@ -199,15 +301,19 @@ class LyftTrainerModule(pl.LightningModule, ABC):
                       world_from_agent=batch["world_from_agent"], centroid=batch["centroid"],
                       return_results=True, attack=not (is_val or is_test), return_trajectory=is_test)
         # if not is_test:
-        for item, value in result.items():
-            self.log(f'{item}/{name}', value.mean(), on_step=not (is_val or is_test), on_epoch=is_val or is_test,
-                     logger=True, sync_dist=True)
+        # results are already reduced to scalars unless per sample trajectories are returned
+        logs = {f'{item}/{name}': value.mean() if value.ndim else value for item, value in result.items()}
+        self.log_dict(logs, on_step=not (is_val or is_test), on_epoch=is_val or is_test, logger=True, sync_dist=True)
         if is_test:
             return result
         if not is_val:
             return result['loss']
 
     def training_step(self, batch, batch_idx, optimizer_idx=None):
+        # releasing cached blocks fragmented by short-lived pgd intermediates every once in a while
+        if self.hparams.empty_cache_freq and self.global_step and \
+                self.global_step % self.hparams.empty_cache_freq == 0 and torch.cuda.is_available():
+            torch.cuda.empty_cache()
         return self.step(batch, batch_idx, optimizer_idx, name='train')
 
     def validation_step(self, batch, batch_idx):
@@ -281,4 +387,16 @@ class LyftTrainerModule(pl.LightningModule, ABC):
                             help='additional saliency supervision specific args')
         parser.add_argument('--track-grad', type=boolify, default=False,
                             help='whether to log grad norms')
+        parser.add_argument('--adv-log-freq', type=int, default=None,
+                            help='interval (in steps) of evaluating pgd attack losses for logging, 0 disables '
+                                 '(defaults to the trainer\'s log_every_n_steps)')
+        parser.add_argument('--channels-last', type=boolify, default=False,
+                            help='whether to use channels last memory format for model inputs and weights')
+        parser.add_argument('--compile-mode', type=str, default=None,
+                            help='torch.compile mode for the model [default/reduce-overhead/max-autotune]')
+        parser.add_argument('--empty-cache-freq', type=int, default=64,
+                            help='interval (in steps) of releasing cached cuda memory, 0 disables')
+        parser.add_argument('--autocast', type=str, default=None,
+                            help='mixed precision dtype for model forward passes [bfloat16/float16] '
+                                 '(float16 should be paired with loss scaling)')
         return parser
@@ -48,8 +48,10 @@ def find_batch_extremes(batch, batch_loss, outputs, k=5, require_grad=False, to_
 
 # --- Function utils ---
 # Original code from https://github.com/lyft/l5kit/blob/20ab033c01610d711c3d36e1963ecec86e8b85b6/l5kit/l5kit/evaluation/metrics.py
+# scripted so that the elementwise arithmetic gets fused, as it is evaluated on every pgd iteration
+@torch.jit.script
 def neg_multi_log_likelihood(
-        gt: torch.Tensor, pred: torch.Tensor, confidences: torch.Tensor, avails: torch.Tensor = None
+        gt: torch.Tensor, pred: torch.Tensor, confidences: torch.Tensor, avails: Optional[torch.Tensor] = None
 ) -> torch.Tensor:
     """
     Compute a negative log-likelihood for the multi-modal scenario.
@@ -65,20 +67,18 @@ def neg_multi_log_likelihood(
     Returns:
         Tensor: negative log-likelihood for this example, a single float number
     """
-    batch_size, num_modes, future_len, num_coords = pred.shape
-
     # convert to (batch_size, num_modes, future_len, num_coords)
     if len(gt.shape) != len(pred.shape):
         gt = torch.unsqueeze(gt, 1)  # add modes
     if avails is not None:
-        avails = avails[:, None, :, None]  # add modes and cords
+        mask = avails[:, None, :, None]  # add modes and cords
         # error (batch_size, num_modes, future_len)
-        error = torch.sum(((gt - pred) * avails) ** 2, dim=-1)  # reduce coords and use availability
+        error = torch.sum(((gt - pred) * mask) ** 2, dim=-1)  # reduce coords and use availability
     else:
         error = torch.sum((gt - pred) ** 2, dim=-1)  # reduce coords and use availability
-    with np.errstate(divide="ignore"):  # when confidence is 0 log goes to -inf, but we're fine with it
-        # error (batch_size, num_modes)
-        error = torch.log(confidences) - 0.5 * torch.sum(error, dim=-1)  # reduce time
+    # when confidence is 0 log goes to -inf, but we're fine with it
+    # error (batch_size, num_modes)
+    error = torch.log(confidences) - 0.5 * torch.sum(error, dim=-1)  # reduce time
 
     # use max aggregator on modes for numerical stability
     # error (batch_size, num_modes)
@@ -86,6 +86,15 @@ def neg_multi_log_likelihood(
     error = -torch.log(torch.sum(torch.exp(error - max_value), dim=-1, keepdim=True)) - max_value  # reduce modes
     return error.reshape(-1)
 
+
+@torch.jit.script
+def perturb(inputs: torch.Tensor, delta: torch.Tensor) -> torch.Tensor:
+    """
+    Apply a perturbation to raster inputs, keeping them in the valid [0, 1] range.
+    Scripted so that the addition and clamping are fused into a single pass.
+    """
+    return torch.clamp(inputs + delta, 0., 1.)
+
 # --- Function utils ---
 # Original code from https://github.com/lyft/l5kit/blob/20ab033c01610d711c3d36e1963ecec86e8b85b6/l5kit/l5kit/evaluation/csv_utils.py
 def _generate_coords_keys(future_len: int, mode_index: int = 0) -> List[str]: